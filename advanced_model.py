@@ -1,102 +1,153 @@
+import copy
 import time
-start_time = time.time() #Starting timer
-print("Program started")
-
-import sys
-sys.path.append(".")
-import modin.pandas as pd
+import numpy as np
+import pandas as pd
+import dask
 import dask.dataframe as dd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from pandarallel import pandarallel
+from dask import delayed
+from dask.distributed import Client, LocalCluster
+from sklearn.feature_extraction.text import HashingVectorizer
 from sklearn.naive_bayes import ComplementNB
+from sklearn.preprocessing import normalize
 from sklearn.metrics import accuracy_score, classification_report
+from utils.pandas_csv_reader import row_block_ranges, read_csv_range
+"""
+TF-IDF + Complement Naive Bayes, run out-of-core on a local dask cluster.
+
+The processed splits are read in partitions of about BLOCK_SIZE bytes, so they can be used
+directly (no need for convert_to_lesser.py) and are never loaded into memory all at once:
+1. Every partition is hashed to term counts. Hashing is stateless, so no vocabulary has to be fitted
+   and all partitions can be done in parallel. The document frequencies of all partitions are summed to the idf.
+2. The model is trained with ComplementNB.partial_fit, one partition after the other, while the
+   workers read and vectorize the next partitions in parallel.
+3. Predictions are made per partition, only the labels and predictions are collected.
+"""
+
+TEXT_COLUMN = 'content-tokens_stemmed'
+# Bytes of csv per partition
+BLOCK_SIZE = 64_000_000
+# 2^20 hashed features, so there are few collisions among the ~700,000 unique words (look at count_unique.py)
+N_FEATURES = 2**20
+N_WORKERS = 4
+
+# Tokens are already stemmed and space separated by the preprocessor
+vectorizer = HashingVectorizer(
+    n_features=N_FEATURES,
+    tokenizer=str.split,
+    token_pattern=None,
+    lowercase=False,
+    alternate_sign=False,
+    norm=None
+)
+
+
+def _read_partition(byte_range, filepath, label_column, positive_label):
+    df = read_csv_range(filepath, *byte_range, columns=[label_column, TEXT_COLUMN], dtypes={TEXT_COLUMN: str})
+    # 1 for reliable/true, 0 for anything else (like categorize_reliable_or_fake and categorize_true_or_false)
+    return pd.DataFrame({
+        'text': df[TEXT_COLUMN].fillna(''),
+        'binary_type': (df[label_column].astype(str).str.lower() == positive_label).astype(np.int8),
+    })
+
+
+def read_split(filepath, label_column='label', positive_label='reliable') -> dd.DataFrame:
+    """Dask dataframe with 'text' and 'binary_type' columns, partitioned on row boundaries."""
+    meta = pd.DataFrame({'text': pd.Series(dtype=str), 'binary_type': pd.Series(dtype=np.int8)})
+    return dd.from_map(_read_partition, row_block_ranges(filepath, BLOCK_SIZE), filepath=filepath,
+                       label_column=label_column, positive_label=positive_label, meta=meta)
+
 
-print("test")
+def document_frequency(partition):
+    counts = vectorizer.transform(partition['text'])
+    return np.bincount(counts.indices, minlength=N_FEATURES), counts.shape[0]
 
-from utils.f1_score_model import categorize_reliable_or_fake
-from utils.f1_score_model import categorize_true_or_false
 
-print("test")
+def add(a, b):
+    return a[0] + b[0], a[1] + b[1]
 
-pandarallel.initialize(progress_bar=True, nb_workers=4)
 
-print("Pandarrell initialized, reading files")
+def tree_sum(values):
+    # Sum pairwise, so no worker has to hold the document frequencies of every partition at once
+    while len(values) > 1:
+        values = [delayed(add)(values[i], values[i + 1]) if i + 1 < len(values) else values[i]
+                  for i in range(0, len(values), 2)]
+    return values[0]
 
-#reading files with dask, using reduced data-sets to lessen the load for the script (look at conver_to_lesser.py)
-train_data = dd.read_csv('output/reduced_train.csv', usecols=["label", "content-tokens_stemmed"])
-test_data = dd.read_csv('output/reduced_test.csv', usecols=["label", "content-tokens_stemmed"])
-val_data = dd.read_csv('output/reduced_val.csv', usecols=["label", "content-tokens_stemmed"])
 
-#liar data also
-liar_test_data = dd.read_csv('output/reduced_liar.csv', usecols=["type", "content-tokens_stemmed"])
+def smooth_idf(frequency_and_count):
+    # Same formula as TfidfVectorizer with smooth_idf=True
+    frequency, n_docs = frequency_and_count
+    return np.log((1 + n_docs) / (1 + frequency)) + 1
 
-print("files read")
 
-print("Converting to pandas dataframe")
+def tfidf(partition, idf):
+    matrix = vectorizer.transform(partition['text']).astype(np.float64)
+    matrix.data *= idf[matrix.indices]
+    return normalize(matrix, copy=False), partition['binary_type'].to_numpy()
 
-# Convert to Pandas
-train_data = train_data.compute()
-test_data = test_data.compute()
-val_data = val_data.compute()
-liar_test_data = liar_test_data.compute()
 
-# Convert preprocessed text into TF-IDF features. 50.000 features since there are 700.000 unique words (look at count_unique.py)
-vectorizer = TfidfVectorizer(max_features=50_000)
+def partial_fit(model, data):
+    matrix, labels = data
+    # Dask may rerun a task (e.g. after a worker dies), so the input model must not be changed or it is trained twice
+    model = copy.deepcopy(model)
+    model.partial_fit(matrix, labels, classes=[0, 1])
+    return model
 
-print("applying vectorizor")
 
-tfidf_train = vectorizer.fit_transform(train_data['content-tokens_stemmed'].astype(str))
-#since the model will expect numerical TF-IDF weights as its input, also transform the test, and validation sets
-tfidf_test = vectorizer.transform(test_data["content-tokens_stemmed"].astype(str))
-tfidf_val = vectorizer.transform(val_data["content-tokens_stemmed"].astype(str))
+def predict(model, data):
+    matrix, labels = data
+    return labels, model.predict(matrix).astype(np.int8)
 
-#also transforming liar set:
-tfidf_liar_test = vectorizer.transform(liar_test_data["content-tokens_stemmed"].astype(str))
 
-print("assignming labels")
+def train(train_data):
+    partitions = train_data.to_delayed()
 
-# Parallelize label assignment with pandarallel
-train_data["binary_type"] = train_data["label"].parallel_apply(categorize_reliable_or_fake)
-test_data["binary_type"] = test_data["label"].parallel_apply(categorize_reliable_or_fake)
-val_data["binary_type"] = val_data["label"].parallel_apply(categorize_reliable_or_fake)
+    print(f"[#] Computing idf over {len(partitions)} partitions...")
+    idf = delayed(smooth_idf)(tree_sum([delayed(document_frequency)(p) for p in partitions]))
+    idf = idf.persist()
 
-#labeling liar set 1 and 0
-liar_test_data["binary_type"] = liar_test_data["type"].parallel_apply(categorize_true_or_false)
+    print("[#] Training model...")
+    model = delayed(ComplementNB)()
+    for partition in partitions:
+        model = delayed(partial_fit)(model, delayed(tfidf)(partition, idf))
+    return model.compute(), idf
 
-print("Done with assigning labels, converting labels to numpy arrays")
 
-# Convert labels to numpy arrays
-training_labels = train_data["binary_type"].to_numpy()
-test_labels = test_data["binary_type"].to_numpy()
-val_labels = val_data["binary_type"].to_numpy()
+def evaluate(model, idf, data, name):
+    results = dask.compute(*[delayed(predict)(model, delayed(tfidf)(p, idf)) for p in data.to_delayed()])
+    labels = np.concatenate([labels for labels, _ in results])
+    predictions = np.concatenate([predictions for _, predictions in results])
+    print(f"Model Accuracy for {name} data: {accuracy_score(labels, predictions) * 100:.2f} %")
+    return labels, predictions
 
-liar_test_labels = liar_test_data["binary_type"].to_numpy()
 
-print("Training Model")
+def main():
+    start_time = time.time()
+    print("Program started")
 
-# Train Naive Bayes Classifier
-model = ComplementNB()
-model.fit(tfidf_train, training_labels)
+    with LocalCluster(n_workers=N_WORKERS, threads_per_worker=1, processes=True) as cluster, Client(cluster) as client:
+        print(f"[#] Dask dashboard at {client.dashboard_link}")
 
-print("Predicting values")
+        train_data = read_split('output/995,000_rows_processed_train.csv')
+        test_data = read_split('output/995,000_rows_processed_test.csv')
+        # LIAR's test.tsv, see the order of the LIAR files in preprocess.py
+        liar_test_data = read_split('output/liar_processed_test.csv', label_column='type', positive_label='true')
 
-# Test Model
-test_pred = model.predict(tfidf_test)
-train_pred = model.predict(tfidf_train)
+        model, idf = train(train_data)
+        # The model is only a few feature count arrays, send it to the workers once
+        model = client.scatter(model, broadcast=True)
 
-#testing on liar test
-liar_test_pred = model.predict(tfidf_liar_test)
+        print("evaluating model")
+        evaluate(model, idf, train_data, "training")
+        test_labels, test_pred = evaluate(model, idf, test_data, "test")
+        print(f"Model Report:\n\n{classification_report(test_labels, test_pred)}")
 
-print("evaluating model")
+        liar_test_labels, liar_test_pred = evaluate(model, idf, liar_test_data, "liar test")
+        print(f"Model Report:\n\n{classification_report(liar_test_labels, liar_test_pred)}")
 
-# Evaluate Model
-print(f"Model Accuracy for training data: {accuracy_score(training_labels, train_pred) * 100:.2f} %")
-print(f"Model Accuracy for test data: {accuracy_score(test_labels, test_pred) * 100:.2f} %")
-print(f"Model Report:\n\n{classification_report(test_labels, test_pred)}")
+    elapsed_time = time.time() - start_time
+    print(f"Script execution time: {elapsed_time:.2f} seconds")
 
-print(f"Model Accuracy for liar test data: {accuracy_score(liar_test_labels, liar_test_pred) * 100:.2f} %")
-print(f"Model Report:\n\n{classification_report(liar_test_labels, liar_test_pred)}")
 
-end_time = time.time() #ending timer
-elapsed_time = end_time - start_time
-print(f"Script execution time: {elapsed_time:.2f} seconds")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
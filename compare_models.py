@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
+from sklearn.linear_model import LogisticRegression
+from sklearn.naive_bayes import ComplementNB
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import f1_score
+from utils.token_corpus import encode_splits, vectorize
+"""
+Trains several models on the same features and prints one comparison table.
+
+The processed splits are loaded and vectorized once (through the encoded token corpus, see
+utils/token_corpus.py) and the models are trained at the same time in separate processes.
+The CPU budget is split between them so they do not all try to use every core.
+"""
+
+SPLITS = {
+    'train': './output/995,000_rows_processed_train.csv',
+    'val': './output/995,000_rows_processed_val.csv',
+    'test': './output/995,000_rows_processed_test.csv',
+}
+CORPUS_DIR = './output/995,000_rows_encoded'
+
+# Feature sets are built once and shared by every model that uses them
+FEATURE_SETS = {
+    # Same settings as the CountVectorizer in logistic_regressor.py and test_model.py
+    'binary_10k': dict(max_features=10_000, min_df=5, max_df=0.95, binary=True, dtype=np.uint8),
+    # 50,000 most frequent tokens with tf-idf, like the TfidfVectorizer advanced_model.py used before it was moved to dask.
+    # advanced_model.py now hashes all tokens to 2^20 features, so complement_nb here is a smaller version of that model
+    'tfidf_50k': dict(max_features=50_000, min_df=1, max_df=1.0, tfidf=True),
+}
+
+# name -> (function making the model from its number of cpus, feature set, whether it can use more than one cpu)
+MODELS = {
+    'logistic_regression': (lambda n_jobs: LogisticRegression(
+        max_iter=10000, random_state=42, class_weight='balanced'), 'binary_10k', False),
+    'complement_nb': (lambda n_jobs: ComplementNB(), 'tfidf_50k', False),
+    'random_forest': (lambda n_jobs: RandomForestClassifier(
+        random_state=42, class_weight='balanced', max_depth=30, n_jobs=n_jobs), 'binary_10k', True),
+}
+
+
+def split_cpus(model_names, cpus):
+    """
+    Give every model that can only use one cpu a single cpu and split the rest evenly between the
+    models that can use more. Returns name -> cpus and how many models can run at the same time.
+    """
+    parallel = [name for name in model_names if MODELS[name][2]]
+    serial = [name for name in model_names if not MODELS[name][2]]
+    if len(model_names) >= cpus:
+        # Not enough cpus to run everything at once, run cpus models at a time with one cpu each
+        return {name: 1 for name in model_names}, cpus
+
+    shares = {name: 1 for name in serial}
+    spare = cpus - len(serial)
+    for i, name in enumerate(parallel):
+        # Spread the remainder over the first models so all cpus are used
+        shares[name] = spare // len(parallel) + (1 if i < spare % len(parallel) else 0)
+    return shares, len(model_names)
+
+
+def _is_encoded(corpus_dir):
+    meta_path = os.path.join(corpus_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as file:
+        # Corpora encoded before 'true' validation labels counted as reliable have no positive_labels
+        return 'positive_labels' in json.load(file)
+
+
+def train_and_evaluate(name, make_model, n_jobs, X_train, y_train, X_val, y_val, X_test, y_test):
+    # Limit BLAS/OpenMP threads too, otherwise numpy inside every process would use all cores
+    with threadpool_limits(limits=n_jobs):
+        model = make_model(n_jobs)
+
+        start_time = time.time()
+        model.fit(X_train, y_train)
+        fit_time = time.time() - start_time
+
+        val_pred = model.predict(X_val)
+        start_time = time.time()
+        test_pred = model.predict(X_test)
+        predict_time = time.time() - start_time
+
+    print(f"[#] {name} done in {fit_time:.2f} seconds")
+    return {
+        'model': name,
+        'cpus': n_jobs,
+        'val_f1': f1_score(y_val, val_pred),
+        'test_f1': f1_score(y_test, test_pred),
+        'fit_time_s': fit_time,
+        'predict_us_per_article': predict_time / X_test.shape[0] * 1e6,
+    }
+
+
+def compare_models(model_names, cpus, corpus_dir=CORPUS_DIR, splits=SPLITS):
+    if not _is_encoded(corpus_dir):
+        print("[#] Encoding splits (only needed once)...")
+        encode_splits(splits, corpus_dir)
+
+    print("[#] Vectorizing data...")
+    features = {}
+    for feature_set in {MODELS[name][1] for name in model_names}:
+        start_time = time.time()
+        features[feature_set], _ = vectorize(corpus_dir, ('train', 'val', 'test'), **FEATURE_SETS[feature_set])
+        print(f"[#] {feature_set} built in {time.time() - start_time:.2f} seconds")
+
+    shares, concurrent = split_cpus(model_names, cpus)
+    print(f"[#] Training {len(model_names)} models, {concurrent} at a time, cpus: {shares}")
+
+    jobs = []
+    for name in model_names:
+        make_model, feature_set, _ = MODELS[name]
+        data = features[feature_set]
+        jobs.append(delayed(train_and_evaluate)(
+            name, make_model, shares[name], *data['train'], *data['val'], *data['test']
+        ))
+    results = Parallel(n_jobs=concurrent)(jobs)
+
+    return pd.DataFrame(results).set_index('model')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and compare several models on shared features")
+    parser.add_argument('--models', default=','.join(MODELS),
+                        help=f"Comma separated models to train, from: {', '.join(MODELS)}")
+    parser.add_argument('--cpus', type=int, default=os.cpu_count(), help="Number of cpus to split between the models")
+    parser.add_argument('--output', default='./output/model_comparison.csv', help="Where the comparison table is saved")
+    args = parser.parse_args()
+
+    if args.cpus < 1:
+        parser.error(f"--cpus must be at least 1, got {args.cpus}")
+
+    model_names = args.models.split(',')
+    unknown = [name for name in model_names if name not in MODELS]
+    if unknown:
+        parser.error(f"Unknown models: {', '.join(unknown)}")
+
+    start_time = time.time()
+    table = compare_models(model_names, args.cpus)
+    print(f"\n{'-'*50}\nModel comparison:\n{'-'*50}")
+    print(table.to_string(float_format=lambda x: f"{x:.4f}"))
+    table.to_csv(args.output)
+    print(f"\nTotal time: {time.time() - start_time:.2f} seconds, table saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
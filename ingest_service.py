@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import joblib
+import pandas as pd
+from utils.text_normalization import normalize_content
+from utils.prediction_cache import PredictionCache, model_version, score_texts
+"""
+Watches a directory for new csv files of scraped articles (shaped like data/articles_data.csv),
+normalizes them like the rust preprocessor and scores them with a saved model
+(see logistic_regressor.py), appending the results to an output csv log.
+
+Files are read in batches of --batch-size rows. At most --max-pending batches wait in the queue,
+after which reading pauses until the scorers catch up, so memory stays bounded however many
+files arrive. --concurrency processes normalize and score batches in parallel. The service keeps one
+cache of the last --cache-size predictions, so reposted articles are not scored again: the processes
+normalize a batch, it is looked up in the cache and only the misses are sent back to be scored.
+The cache is saved to --cache-path with the stats and on shutdown, so it is kept between runs.
+"""
+
+ARTICLE_COLUMNS = ['content', 'headline', 'date', 'author']
+
+# The model is loaded once in every scoring process
+_model = None
+
+
+def _load_model(model_path):
+    global _model
+    _model = joblib.load(model_path)
+
+
+def normalize_batch(contents):
+    """Normalize a list of article texts like the rust preprocessor, see text_normalization.py."""
+    return [normalize_content(content) for content in contents]
+
+
+def score_batch(stemmed):
+    """Score normalized texts with the model. Returns predictions, reliable-probabilities and the time it took."""
+    start_time = time.time()
+    predictions, scores = score_texts(_model, stemmed)
+    return predictions, scores, time.time() - start_time
+
+
+class IngestService:
+    def __init__(self, watch_dir, model_path, output_log, batch_size=500, concurrency=2,
+                 max_pending=8, poll_interval=2.0, stats_interval=10.0, cache_size=100_000, cache_path=None):
+        self.watch_dir = watch_dir
+        self.model_path = model_path
+        self.output_log = output_log
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.stats_interval = stats_interval
+        self.cache_size = cache_size
+        self.cache_path = cache_path
+        # Created in run(), once the model is known to exist
+        self.cache = None
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.write_lock = asyncio.Lock()
+
+        # Files that are fully scored are recorded so restarting the service does not score them again.
+        # Files that could not be read or scored are recorded with the reason and also skipped,
+        # until they are changed (the key includes size and modification time)
+        self.done_path = output_log + '.done'
+        self.failed_path = output_log + '.failed'
+        self.done_files = set()
+        if os.path.exists(self.done_path):
+            with open(self.done_path) as file:
+                self.done_files = {line.rstrip('\n') for line in file}
+        if os.path.exists(self.failed_path):
+            with open(self.failed_path) as file:
+                self.done_files |= {line.split('\t')[0] for line in file}
+        self.seen_sizes = {}
+        self.open_batches = {}
+        self.finished_reading = set()
+        self.failed_files = {}
+
+        self.start_time = time.time()
+        self.articles_scored = 0
+        self.articles_skipped = 0
+        self.batches_scored = 0
+        self.files_scored = 0
+        self.articles_failed = 0
+        self.files_failed = 0
+
+    def stats(self) -> dict:
+        elapsed = time.time() - self.start_time
+        cache_stats = self.cache.stats() if self.cache is not None else {'hit_rate': 0.0, 'seconds_saved': 0.0}
+        return {
+            'articles_scored': self.articles_scored,
+            'articles_skipped': self.articles_skipped,
+            'batches_scored': self.batches_scored,
+            'files_scored': self.files_scored,
+            'articles_failed': self.articles_failed,
+            'files_failed': self.files_failed,
+            'articles_per_second': self.articles_scored / elapsed if elapsed > 0 else 0.0,
+            'queue_depth': self.queue.qsize(),
+            'queue_max': self.queue.maxsize,
+            'cache_hit_rate': cache_stats['hit_rate'],
+            'cache_seconds_saved': cache_stats['seconds_saved'],
+        }
+
+    async def run(self, once=False):
+        """
+        Run until cancelled (Ctrl-C). With once=True, score the files already in watch_dir and return.
+        Bad files and batches are logged and skipped, but if the scoring processes break (e.g. the
+        model can not be loaded) the service stops with a RuntimeError.
+        """
+        if not os.path.isfile(self.model_path):
+            raise FileNotFoundError(f"Model {self.model_path} does not exist.")
+        if not os.path.isdir(self.watch_dir):
+            raise FileNotFoundError(f"Directory {self.watch_dir} does not exist.")
+        self.cache = PredictionCache(None, model_version(self.model_path), max_size=self.cache_size,
+                                     path=self.cache_path)
+
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=self.concurrency, initializer=_load_model,
+                                 initargs=(self.model_path,)) as executor:
+            scorers = [asyncio.create_task(self._score(loop, executor)) for _ in range(self.concurrency)]
+            reporter = asyncio.create_task(self._report())
+            watcher = asyncio.create_task(self._watch(once))
+            stopper = None
+            try:
+                await self._wait_for(watcher, scorers)
+                stopper = asyncio.create_task(self._stop_scorers(len(scorers)))
+                await self._wait_for(stopper, scorers)
+                await asyncio.gather(*scorers)
+            finally:
+                for task in [reporter, watcher, stopper, *scorers]:
+                    if task is not None:
+                        task.cancel()
+                self._write_stats()
+                if self.cache_path is not None:
+                    self.cache.save()
+                print(f"[#] Stopped: {self._stats_line()}")
+
+    async def _wait_for(self, task, scorers):
+        # Waits for task, but a scorer that fails (only on a broken process pool) stops the wait straight away,
+        # otherwise the reader would block forever on the full queue
+        pending = {task, *scorers}
+        while task in pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                if finished.exception() is not None:
+                    raise finished.exception()
+
+    async def _stop_scorers(self, n_scorers):
+        for _ in range(n_scorers):
+            await self.queue.put(None)
+
+    def _file_key(self, path):
+        stat = os.stat(path)
+        return f"{os.path.basename(path)}|{stat.st_size}|{int(stat.st_mtime)}"
+
+    def _new_files(self, wait_until_stable):
+        # A file is only read once its size is the same on two polls in a row, so half copied files are skipped
+        paths = []
+        for name in sorted(os.listdir(self.watch_dir)):
+            path = os.path.join(self.watch_dir, name)
+            if not name.endswith('.csv') or not os.path.isfile(path):
+                continue
+            try:
+                key = self._file_key(path)
+                size = os.path.getsize(path)
+            except OSError:
+                # Removed or renamed since listing the directory
+                continue
+            if key in self.done_files or key in self.open_batches:
+                continue
+            if wait_until_stable and self.seen_sizes.get(path) != size:
+                self.seen_sizes[path] = size
+                continue
+            paths.append((path, key))
+        return paths
+
+    async def _watch(self, once):
+        while True:
+            for path, key in self._new_files(wait_until_stable=not once):
+                await self._read_file(path, key)
+            if once:
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    async def _read_file(self, path, key):
+        print(f"[#] Reading {path}")
+        self.open_batches[key] = 0
+        try:
+            columns = await asyncio.to_thread(lambda: pd.read_csv(path, nrows=0).columns)
+            if 'content' not in columns:
+                raise ValueError(f"no 'content' column (columns: {', '.join(columns)})")
+            with pd.read_csv(path, usecols=lambda column: column in ARTICLE_COLUMNS,
+                             chunksize=self.batch_size) as reader:
+                while True:
+                    batch = await asyncio.to_thread(next, reader, None)
+                    if batch is None:
+                        break
+                    self.open_batches[key] += 1
+                    # Blocks while the queue is full (backpressure)
+                    await self.queue.put((path, key, batch))
+        except Exception as e:
+            # Batches that were already queued are still scored, the file is recorded as failed
+            self._fail(path, key, f"could not be read: {e!r}")
+        self.finished_reading.add(key)
+        await self._mark_done_if_finished(key)
+
+    def _fail(self, path, key, reason):
+        print(f"[!] {path} {reason}, skipping it")
+        self.failed_files.setdefault(key, reason)
+
+    async def _score(self, loop, executor):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            path, key, batch = item
+            try:
+                await self._score_batch(loop, executor, path, batch)
+            except BrokenProcessPool as e:
+                raise RuntimeError(f"The scoring processes crashed or could not load the model {self.model_path}") from e
+            except Exception as e:
+                traceback.print_exc()
+                self._fail(path, key, f"batch starting at row {batch.index[0]} could not be scored: {e!r}")
+                self.articles_failed += len(batch)
+            finally:
+                self.open_batches[key] -= 1
+            await self._mark_done_if_finished(key)
+
+    async def _score_batch(self, loop, executor, path, batch):
+        stemmed = await loop.run_in_executor(executor, normalize_batch, batch['content'].tolist())
+        predictions, scores, missing = self.cache.lookup(stemmed)
+        if missing:
+            new_predictions, new_scores, model_seconds = await loop.run_in_executor(
+                executor, score_batch, [stemmed[rows[0]] for rows in missing.values()])
+            self.cache.store(missing, predictions, scores, new_predictions, new_scores, model_seconds)
+
+        result = batch.reindex(columns=['headline', 'date', 'author'])
+        result.insert(0, 'row', batch.index)
+        result.insert(0, 'source_file', os.path.basename(path))
+        result['prediction'] = ['reliable' if prediction == 1 else 'fake' for prediction in predictions]
+        result['reliable_probability'] = scores
+        result['scored_at'] = pd.Timestamp.now().isoformat(timespec='seconds')
+        # Like the rust preprocessor, articles with no tokens left after cleaning are dropped
+        has_tokens = [len(text) > 0 for text in stemmed]
+        result = result[has_tokens]
+
+        async with self.write_lock:
+            await asyncio.to_thread(self._append, result)
+            self.articles_scored += len(result)
+            self.articles_skipped += len(batch) - len(result)
+            self.batches_scored += 1
+
+    def _append(self, result):
+        header = not os.path.exists(self.output_log)
+        result.to_csv(self.output_log, mode='a', header=header, index=False)
+
+    async def _mark_done_if_finished(self, key):
+        async with self.write_lock:
+            if key in self.finished_reading and self.open_batches.get(key) == 0:
+                del self.open_batches[key]
+                self.finished_reading.discard(key)
+                self.done_files.add(key)
+                if key in self.failed_files:
+                    self.files_failed += 1
+                    with open(self.failed_path, 'a') as file:
+                        file.write(f"{key}\t{self.failed_files.pop(key)}\n")
+                else:
+                    self.files_scored += 1
+                    with open(self.done_path, 'a') as file:
+                        file.write(key + '\n')
+
+    def _stats_line(self):
+        stats = self.stats()
+        return (f"{stats['articles_scored']} articles scored ({stats['articles_per_second']:.1f}/s), "
+                f"{stats['articles_skipped']} skipped, queue {stats['queue_depth']}/{stats['queue_max']} batches, "
+                f"{stats['files_scored']} files done, {stats['files_failed']} failed, cache hit rate {stats['cache_hit_rate']:.1%} "
+                f"({stats['cache_seconds_saved']:.1f}s saved)")
+
+    def _write_stats(self):
+        # Written next to the output log so throughput and queue depth can be checked from outside
+        with open(self.output_log + '.stats.json', 'w') as file:
+            json.dump(self.stats(), file, indent=2)
+
+    async def _save_cache(self):
+        # The dump is written in a thread so reading and scoring go on meanwhile, only the copy is made here
+        if self.cache_path is not None:
+            await asyncio.to_thread(self.cache.save, self.cache.snapshot())
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self._write_stats()
+            await self._save_cache()
+            print(f"[#] {self._stats_line()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score new article csv files as they appear in a directory")
+    parser.add_argument('--watch-dir', default='./data/incoming', help="Directory new csv files are put in")
+    parser.add_argument('--model', default='./output/logistic_regressor.joblib', help="Saved model from logistic_regressor.py")
+    parser.add_argument('--output', default='./output/ingest_scores.csv', help="Csv log the scores are appended to")
+    parser.add_argument('--batch-size', type=int, default=500, help="Articles per batch")
+    parser.add_argument('--concurrency', type=int, default=2, help="Number of scoring processes")
+    parser.add_argument('--max-pending', type=int, default=8, help="Max batches waiting to be scored before reading pauses")
+    parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds between directory scans")
+    parser.add_argument('--cache-size', type=int, default=100_000, help="Max number of cached predictions")
+    parser.add_argument('--cache-path', default='./output/ingest_prediction_cache.joblib',
+                        help="File the prediction cache is kept in between runs")
+    parser.add_argument('--once', action='store_true', help="Score the files already in the directory and exit")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.model):
+        parser.error(f"Model {args.model} does not exist, run logistic_regressor.py first")
+    os.makedirs(args.watch_dir, exist_ok=True)
+    service = IngestService(args.watch_dir, args.model, args.output, batch_size=args.batch_size,
+                            concurrency=args.concurrency, max_pending=args.max_pending,
+                            poll_interval=args.poll_interval, cache_size=args.cache_size,
+                            cache_path=args.cache_path)
+    print(f"[#] Watching {args.watch_dir}, press Ctrl-C to stop")
+    try:
+        asyncio.run(service.run(once=args.once))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
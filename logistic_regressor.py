@@ -4,10 +4,12 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import f1_score, classification_report
 import numpy as np
 from pandarallel import pandarallel
-from sklearn.model_selection import GridSearchCV
 from sklearn.pipeline import Pipeline
 import time
+import joblib
 from sklearn.model_selection import StratifiedKFold
+from utils.checkpointed_search import CheckpointedGridSearch
+from utils.text_normalization import identity_tokenizer
 
 pandarallel.initialize(progress_bar=True, verbose=0)
 
@@ -46,14 +48,15 @@ def load_datasets(train_csv, valid_csv, test_csv, column_name='content-tokens_st
 
     return train_text, valid_text, test_text, y_train, y_valid, y_test
 
-def optimize_model(train_text, valid_text, test_text, y_train, y_valid, y_test):
+def optimize_model(train_text, valid_text, test_text, y_train, y_valid, y_test, model_path='./output/logistic_regressor.joblib'):
     """
     Optimize and train a logistic regression model with hyperparameter tuning.
+    The fitted vectorizer and best classifier are saved to model_path as one pipeline taking token lists.
     """
     
     print("[#] Setting up vectorizer...")
     vectorizer = CountVectorizer(
-            tokenizer=lambda x: x,
+            tokenizer=identity_tokenizer,
             token_pattern=None,
             lowercase=False,
             binary=True,
@@ -95,14 +98,15 @@ def optimize_model(train_text, valid_text, test_text, y_train, y_valid, y_test):
     # Define cross-validation
     cv = StratifiedKFold(n_splits=5, shuffle=True, random_state=42)
     
-    # Use validation set for evaluation during grid search
-    grid_search = GridSearchCV(
+    # Every finished fit is saved to the checkpoint, so rerunning after a crash resumes the search
+    grid_search = CheckpointedGridSearch(
         pipeline,
         param_grid,
+        checkpoint_path='./output/logistic_regressor_search.jsonl',
         cv=cv,
         scoring='f1',
         n_jobs=-1,  # Use all available cores
-        verbose=3
+        verbose=1
     )
     
     # Combine train and validation for more training data (optional)
@@ -126,10 +130,8 @@ def optimize_model(train_text, valid_text, test_text, y_train, y_valid, y_test):
     
     print(f"\nValidation F1 Score: {valid_f1:.4f}")
     
-    # Retrain on combined train+validation data with best parameters
-    print("\n[#] Retraining on train data with best parameters...")
+    # The search has already fitted the best parameters on the train data
     best_pipeline = grid_search.best_estimator_
-    best_pipeline.fit(train_text, y_train)
     
     # Evaluate on test set
     test_pred = best_pipeline.predict(test_text)
@@ -139,6 +141,13 @@ def optimize_model(train_text, valid_text, test_text, y_train, y_valid, y_test):
     print(f"\nTest F1 Score: {test_f1:.4f}\n")
     print(f"{'-'*50}\nClassification Report:\n{'-'*50}")
     print(classification_report(y_test, test_pred))
+
+    # Save vectorizer + classifier so new articles can be scored without retraining (see ingest_service.py)
+    joblib.dump(Pipeline([
+        ('vectorizer', vectorizer),
+        ('classifier', best_pipeline.named_steps['classifier'])
+    ]), model_path)
+    print(f"[#] Model saved to {model_path}")
     
     return best_pipeline
 
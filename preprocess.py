@@ -48,9 +48,10 @@ def combine_995k_and_articles_data():
 
 def main():
     
-    files = [["test.tsv", "liar_test.csv"],
-             ["train.tsv", "liar_train.csv"],
-             ["valid.tsv", "liar_valid.csv"]]
+    # --three-files writes the input files to _train, _val and _test in this order
+    files = [["train.tsv", "liar_train.csv"],
+             ["valid.tsv", "liar_valid.csv"],
+             ["test.tsv", "liar_test.csv"]]
 
     for file in files:
         print(f"converting {file[0]} to {file[1]}")
@@ -4,9 +4,9 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import f1_score, classification_report
 import numpy as np
 from pandarallel import pandarallel
-from sklearn.model_selection import GridSearchCV
 from sklearn.pipeline import Pipeline
 import time
+from utils.checkpointed_search import CheckpointedGridSearch
 
 pandarallel.initialize(progress_bar=True, verbose=0)
 
@@ -114,14 +114,15 @@ def optimize_model(train_text, valid_text, test_text, y_train, y_valid, y_test,
     
     print("[#] Performing grid search...")
     
-    # Use validation set for evaluation during grid search
-    grid_search = GridSearchCV(
+    # Every finished fit is saved to the checkpoint, so rerunning after a crash resumes the search
+    grid_search = CheckpointedGridSearch(
         pipeline,
         param_grid,
+        checkpoint_path='./output/random_forest_search.jsonl',
         cv=3,
         scoring='f1',
         n_jobs=-1,  # Use all available cores
-        verbose=3
+        verbose=1
     )
     
     # Fit the model with timing
@@ -140,10 +141,8 @@ def optimize_model(train_text, valid_text, test_text, y_train, y_valid, y_test,
     
     print(f"\nValidation F1 Score: {valid_f1:.4f}")
     
-    # Retrain on combined train+validation data with best parameters
-    print("\n[#] Retraining on combined train+validation data with best parameters...")
+    # The search has already fitted the best parameters on the train data
     best_pipeline = grid_search.best_estimator_
-    best_pipeline.fit(np.concatenate([train_text, valid_text]), np.concatenate([y_train, y_valid]))
     
     # Evaluate on test set
     test_pred = best_pipeline.predict(test_text)
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import scipy.sparse as sp
+import joblib
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import ParameterGrid, check_cv
+
+"""
+Grid search that writes every (candidate, fold) result to disk as soon as it finishes.
+Rerunning with the same checkpoint file skips everything that is already done, so a crash
+or Ctrl-C late in a search only loses the fits that were running at the time.
+"""
+
+
+def _params_key(params):
+    # numpy scalars (from np.logspace etc.) are turned into python values so the key is stable between runs
+    return json.dumps({name: value.item() if isinstance(value, np.generic) else value
+                       for name, value in sorted(params.items())}, default=str)
+
+
+def _fingerprint(estimator, scoring, X, y, cv):
+    """
+    Hash of everything a fold score depends on: the estimator with all its parameters, the scoring,
+    the folds and the data itself. Results are only reused if all of them are the same, so e.g. a
+    changed min_df (different features with the same shape) or max_iter starts a new search.
+    """
+    digest = hashlib.sha256()
+    params = sorted(estimator.get_params(deep=True).items())
+    digest.update(f"{estimator!r}|{params!r}|{scoring!r}|{cv!r}|{X.shape}".encode())
+    if sp.issparse(X):
+        X = X.tocsr()
+        arrays = [X.data, X.indices, X.indptr]
+    else:
+        arrays = [np.asarray(X)]
+    for array in arrays + [np.asarray(y)]:
+        digest.update(np.ascontiguousarray(array).view(np.uint8))
+    return digest.hexdigest()
+
+
+def _fit_and_score(estimator, params, fold, X, y, train, test, scorer):
+    estimator = clone(estimator).set_params(**params)
+    start_time = time.time()
+    estimator.fit(X[train], y[train])
+    fit_time = time.time() - start_time
+    start_time = time.time()
+    score = scorer(estimator, X[test], y[test])
+    score_time = time.time() - start_time
+    return params, fold, (score, fit_time, score_time)
+
+
+def load_checkpoint(checkpoint_path, fingerprint=None):
+    """
+    Read finished results from the checkpoint file as a dict of (params key, fold) -> record.
+    A partly written last line from a crash is ignored.
+    """
+    results = {}
+    if not os.path.exists(checkpoint_path):
+        return results
+    with open(checkpoint_path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if fingerprint is None or record["fingerprint"] == fingerprint:
+                results[(record["params"], record["fold"])] = record
+    return results
+
+
+class CheckpointedGridSearch:
+    """
+    Drop-in for the parts of GridSearchCV used in this project (fit, predict, best_params_,
+    best_score_, best_estimator_, cv_results_), with results checkpointed to checkpoint_path.
+
+    The best estimator is fitted once on the full data after the search (like refit=True) and
+    saved next to the checkpoint, so it is also reused when resuming. It should not be fitted again.
+    """
+
+    def __init__(self, estimator, param_grid, checkpoint_path, cv=5, scoring='f1', n_jobs=-1, verbose=1):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.checkpoint_path = checkpoint_path
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+
+    def fit(self, X, y):
+        y = np.asarray(y)
+        cv = check_cv(self.cv, y, classifier=True)
+        scorer = get_scorer(self.scoring)
+        folds = list(cv.split(X, y))
+        candidates = list(ParameterGrid(self.param_grid))
+        fingerprint = _fingerprint(self.estimator, self.scoring, X, y, cv)
+
+        done = load_checkpoint(self.checkpoint_path, fingerprint)
+        todo = [(params, fold) for params in candidates for fold in range(len(folds))
+                if (_params_key(params), fold) not in done]
+        total = len(candidates) * len(folds)
+        print(f"[#] {total - len(todo)}/{total} fits found in checkpoint, running {len(todo)}...")
+
+        os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+        with open(self.checkpoint_path, "a+") as file:
+            # End a partly written line from a crash so it does not swallow the next record
+            if file.tell() > 0:
+                file.seek(file.tell() - 1)
+                if file.read(1) != "\n":
+                    file.write("\n")
+            results = Parallel(n_jobs=self.n_jobs, return_as="generator_unordered")(
+                delayed(_fit_and_score)(self.estimator, params, fold, X, y, *folds[fold], scorer)
+                for params, fold in todo
+            )
+            for finished, (params, fold, (score, fit_time, score_time)) in enumerate(results, start=1):
+                record = {
+                    "fingerprint": fingerprint,
+                    "params": _params_key(params),
+                    "fold": fold,
+                    "score": float(score),
+                    "fit_time": fit_time,
+                    "score_time": score_time,
+                }
+                file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+                done[(record["params"], fold)] = record
+                if self.verbose:
+                    print(f"[CV {fold + 1}/{len(folds)}] {params}; score={score:.4f}, "
+                          f"fit {fit_time:.1f}s ({total - len(todo) + finished}/{total})")
+
+        self.cv_results_ = self._cv_results(candidates, len(folds), done)
+        self.best_index_ = int(np.argmax(self.cv_results_["mean_test_score"]))
+        self.best_params_ = candidates[self.best_index_]
+        self.best_score_ = self.cv_results_["mean_test_score"][self.best_index_]
+        self.best_estimator_ = self._fit_best(X, y, fingerprint)
+        return self
+
+    def _cv_results(self, candidates, n_folds, done):
+        records = [[done[(_params_key(params), fold)] for fold in range(n_folds)] for params in candidates]
+        cv_results = {
+            "params": candidates,
+            "mean_test_score": np.array([np.mean([r["score"] for r in rs]) for rs in records]),
+            "std_test_score": np.array([np.std([r["score"] for r in rs]) for rs in records]),
+            "mean_fit_time": np.array([np.mean([r["fit_time"] for r in rs]) for rs in records]),
+            "mean_score_time": np.array([np.mean([r["score_time"] for r in rs]) for rs in records]),
+        }
+        for fold in range(n_folds):
+            cv_results[f"split{fold}_test_score"] = np.array([rs[fold]["score"] for rs in records])
+        return cv_results
+
+    def _fit_best(self, X, y, fingerprint):
+        best_path = self.checkpoint_path + ".best.joblib"
+        key = (fingerprint, _params_key(self.best_params_))
+        if os.path.exists(best_path):
+            saved_key, estimator = joblib.load(best_path)
+            if saved_key == key:
+                print("[#] Loaded best estimator from checkpoint")
+                return estimator
+
+        print("[#] Fitting best estimator on all training data...")
+        estimator = clone(self.estimator).set_params(**self.best_params_)
+        estimator.fit(X, y)
+        joblib.dump((key, estimator), best_path)
+        return estimator
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
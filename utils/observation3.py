@@ -16,7 +16,7 @@ def wordFrequency(csv_data, content_column):
         counterList.append(wordCounter)
     return counterList
 
-csv_data = read_csv_file('data/news_sample.csv')
+csv_data = read_csv_file('data/news_sample.csv', columns=['content-tokens_no_stop'])
 
 counterList = wordFrequency(csv_data, 'content-tokens_no_stop')
 
@@ -1,11 +1,187 @@
 import pandas
 import os
+import io
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Union
 
-# Reads csv file and returns it as a pandas dataframe
-def read_csv_file(filepath) -> pandas.DataFrame:
+# How much of the file is parsed to estimate the in-memory size of the whole file
+SAMPLE_BYTES = 1_000_000
+
+
+# Reads csv file and returns it as a pandas dataframe, or as dataframe chunks if a memory budget is given
+def read_csv_file(filepath, columns=None, dtypes=None, categoricals=None, memory_budget=None,
+                  workers=1) -> Union[pandas.DataFrame, Iterator[pandas.DataFrame]]:
+    """
+    Read a csv file, optionally only some columns and with explicit dtypes.
+    Returns a dataframe if memory_budget is None, otherwise always an iterator of dataframe chunks.
+
+    Args:
+    filepath (str): Path to the csv file
+    columns (list): Columns to read, all columns if None
+    dtypes (dict): Column name -> dtype
+    categoricals (list or dict): Columns to read as 'category'. A dict maps column -> known categories,
+        which keeps the categories identical across chunks
+    memory_budget (int): Max bytes the parsed data may use. The file is read in chunks that fit the budget,
+        or as a single chunk if the whole file is estimated to fit
+    workers (int): Number of processes used to parse chunks when reading in chunks
+    """
+    if not os.path.exists(filepath):
+        raise FileNotFoundError(f"File {filepath} does not exist.")
+
+    if memory_budget is not None:
+        return _budgeted_chunks(filepath, columns, dtypes, categoricals, memory_budget, workers)
+
+    return pandas.read_csv(filepath, usecols=columns, dtype=_dtype_map(dtypes, categoricals))
+
+
+def _budgeted_chunks(filepath, columns, dtypes, categoricals, memory_budget, workers):
+    if estimate_memory_usage(filepath, columns, dtypes, categoricals) <= memory_budget:
+        yield pandas.read_csv(filepath, usecols=columns, dtype=_dtype_map(dtypes, categoricals))
+        return
+    yield from iter_csv_chunks(filepath, columns, dtypes, categoricals, memory_budget, workers)
+
+
+def iter_csv_chunks(filepath, columns=None, dtypes=None, categoricals=None, memory_budget=256_000_000, workers=1):
+    """
+    Yield the csv file as dataframe chunks in file order, each using roughly at most
+    memory_budget / (chunks in memory at once) bytes. A chunk always holds at least one row,
+    so a single row bigger than that goes over the budget.
+    """
     if not os.path.exists(filepath):
         raise FileNotFoundError(f"File {filepath} does not exist.")
-    return pandas.read_csv(filepath)
+    dtype = _dtype_map(dtypes, categoricals)
+
+    if workers <= 1:
+        rows_per_chunk = max(1, int(memory_budget / _bytes_per_row(filepath, columns, dtype)))
+        yield from pandas.read_csv(filepath, usecols=columns, dtype=dtype, chunksize=rows_per_chunk)
+        return
+
+    # Every worker holds a chunk and a finished chunk waits for each worker, so 2 * workers chunks can be in memory
+    in_flight = 2 * workers
+    block_size = max(1, int(memory_budget / in_flight / _memory_per_file_byte(filepath, columns, dtype)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for header, block in _read_blocks(filepath, block_size):
+            pending.append(executor.submit(_parse_block, header, block, columns, dtype))
+            if len(pending) >= in_flight:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def row_block_ranges(filepath, block_size) -> list:
+    """
+    (start, end) byte ranges of about block_size bytes that each hold whole rows, for reading
+    the file in parallel with read_csv_range. Finding the row boundaries reads the file once.
+    """
+    ranges = []
+    start = None
+    for header, block in _read_blocks(filepath, block_size):
+        start = len(header) if start is None else start
+        ranges.append((start, start + len(block)))
+        start += len(block)
+    return ranges
+
+
+def read_csv_range(filepath, start, end, columns=None, dtypes=None, categoricals=None) -> pandas.DataFrame:
+    """Read the rows in the byte range [start, end) of the file (from row_block_ranges)."""
+    with open(filepath, "rb") as file:
+        header = _read_row(file)
+        file.seek(start)
+        block = file.read(end - start)
+    return _parse_block(header, block, columns, _dtype_map(dtypes, categoricals))
+
+
+def estimate_memory_usage(filepath, columns=None, dtypes=None, categoricals=None) -> int:
+    """Estimate how many bytes the parsed file would use, from parsing the start of the file."""
+    ratio = _memory_per_file_byte(filepath, columns, _dtype_map(dtypes, categoricals))
+    return int(os.path.getsize(filepath) * ratio)
+
+
+def _dtype_map(dtypes, categoricals):
+    dtype = dict(dtypes or {})
+    if isinstance(categoricals, dict):
+        for column, categories in categoricals.items():
+            dtype[column] = pandas.CategoricalDtype(categories)
+    elif categoricals is not None:
+        for column in categoricals:
+            dtype[column] = "category"
+    return dtype or None
+
+
+def _sample(filepath, columns, dtype):
+    header, block = next(_read_blocks(filepath, SAMPLE_BYTES), (b"", b""))
+    if not block:
+        return pandas.DataFrame(), 0
+    df = _parse_block(header, block, columns, dtype)
+    return df, len(header) + len(block)
+
+
+def _bytes_per_row(filepath, columns, dtype) -> float:
+    df, _ = _sample(filepath, columns, dtype)
+    if len(df) == 0:
+        return 1.0
+    return max(1.0, df.memory_usage(deep=True).sum() / len(df))
+
+
+def _memory_per_file_byte(filepath, columns, dtype) -> float:
+    df, sample_size = _sample(filepath, columns, dtype)
+    if sample_size == 0:
+        return 1.0
+    return max(df.memory_usage(deep=True).sum() / sample_size, 0.01)
+
+
+def _parse_block(header, block, columns, dtype) -> pandas.DataFrame:
+    return pandas.read_csv(io.BytesIO(header + block), usecols=columns, dtype=dtype)
+
+
+def _read_blocks(filepath, block_size):
+    """
+    Yield (header, block) pairs of raw bytes where every block ends on a row boundary.
+    A newline is only a row boundary if it is outside quotes, i.e. an even number of quotes
+    came before it, so quoted article text with newlines is never split.
+    """
+    with open(filepath, "rb") as file:
+        header = _read_row(file)
+        rest = b""
+        while True:
+            data = file.read(block_size)
+            if not data:
+                if rest:
+                    yield header, rest
+                return
+            data = rest + data
+            end = _last_row_end(data)
+            if end == -1:
+                # The row is longer than the block, keep reading until it ends
+                rest = data
+                continue
+            yield header, data[:end + 1]
+            rest = data[end + 1:]
+
+
+def _read_row(file) -> bytes:
+    row = b""
+    while True:
+        line = file.readline()
+        row += line
+        if not line or row.count(b'"') % 2 == 0:
+            return row
+
+
+def _last_row_end(data) -> int:
+    # Quote parity at the end of data, then walk newlines backwards adjusting for the quotes after each one
+    quotes = data.count(b'"')
+    end = len(data)
+    while True:
+        newline = data.rfind(b"\n", 0, end)
+        if newline == -1:
+            return -1
+        quotes -= data.count(b'"', newline, end)
+        if quotes % 2 == 0:
+            return newline
+        end = newline
 
 
 # Checks if the dataframe contains processed data
@@ -14,4 +190,4 @@ def is_processed_file(df: pandas.DataFrame) -> bool:
         return True
     elif 'label' in df.columns:
         return False
-    raise ValueError(f"Dataframe does not contain split or processed data.")
\ No newline at end of file
+    raise ValueError(f"Dataframe does not contain split or processed data.")
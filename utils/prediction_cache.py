@@ -0,0 +1,173 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import joblib
+import numpy as np
+
+"""
+Prediction cache for scoring time. The same article is often reposted or syndicated, so predictions are
+cached by a hash of the normalized 'content-tokens_stemmed' text. The cache is a bounded LRU and can be
+saved to disk. Entries are only valid for the model version they were made with, so a cache saved
+for another model is thrown away when loaded.
+"""
+
+
+def model_version(model_path) -> str:
+    """Version of a saved model: a hash of the model file, so a retrained model gets a new version."""
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def content_key(text) -> bytes:
+    # Whitespace is normalized so the same tokens always give the same key
+    text = text if isinstance(text, str) else ''
+    return hashlib.blake2b(" ".join(text.split()).encode('utf-8'), digest_size=16).digest()
+
+
+def score_texts(model, texts, prepare=str.split):
+    """Predictions and reliable-probabilities of the model for 'content-tokens_stemmed' texts, without the cache."""
+    inputs = [prepare(text if isinstance(text, str) else '') for text in texts]
+    if hasattr(model, 'predict_proba'):
+        probabilities = model.predict_proba(inputs)
+        return model.classes_[probabilities.argmax(axis=1)], probabilities[:, 1]
+    predictions = model.predict(inputs)
+    return predictions, predictions.astype(np.float64)
+
+
+class PredictionCache:
+    def __init__(self, model, version, max_size=100_000, path=None, prepare=str.split):
+        """
+        Args:
+        model: Fitted model/pipeline (e.g. the one saved by logistic_regressor.py), or None if the misses
+            are scored somewhere else (e.g. in other processes) and added with lookup() and store()
+        version (str): Model version, see model_version()
+        max_size (int): Max number of cached articles, the least recently used are removed first
+        path (str): File the cache is saved to with save() and loaded from, if given
+        prepare: Turns a 'content-tokens_stemmed' text into the model input (token lists by default)
+        """
+        self.model = model
+        self.version = version
+        self.max_size = max_size
+        self.path = path
+        self.prepare = prepare
+        self.entries = OrderedDict()
+        # Saves can run in another thread, and two of them must not write the temporary file at the same time
+        self.save_lock = threading.Lock()
+        # Snapshots are numbered, so an older snapshot saved late does not overwrite a newer one
+        self.snapshots_taken = 0
+        self.snapshot_saved = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+        # Time the model took and how many articles it scored, kept with the saved cache to estimate the time saved
+        self.model_seconds = 0.0
+        self.model_articles = 0
+
+        if path is not None and os.path.exists(path):
+            saved = joblib.load(path)
+            if saved['version'] == version:
+                self.entries = saved['entries']
+                self.model_seconds, self.model_articles = saved['model_seconds'], saved['model_articles']
+                print(f"[#] Loaded {len(self.entries)} cached predictions from {path}")
+            else:
+                print(f"[#] Cache in {path} is for another model version, starting empty")
+
+    def predict(self, texts):
+        """Predictions and reliable-probabilities for 'content-tokens_stemmed' texts."""
+        if self.model is None:
+            raise ValueError("The cache has no model, score the misses from lookup() and add them with store()")
+        predictions, probabilities, missing = self.lookup(texts)
+        if missing:
+            start_time = time.time()
+            new_predictions, new_probabilities = score_texts(self.model, [texts[rows[0]] for rows in missing.values()],
+                                                             self.prepare)
+            self.store(missing, predictions, probabilities, new_predictions, new_probabilities,
+                       time.time() - start_time)
+        return predictions, probabilities
+
+    def lookup(self, texts):
+        """
+        Look texts up in the cache. Returns the predictions and probabilities, which are only filled in for
+        the hits, and the misses as a dict of key -> rows with that text. Only the first row of every miss
+        has to be scored, texts repeated within the batch are counted as hits.
+        """
+        start_time = time.time()
+        predictions = np.empty(len(texts), dtype=np.int64)
+        probabilities = np.empty(len(texts), dtype=np.float64)
+
+        missing = {}
+        for i, text in enumerate(texts):
+            key = content_key(text)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                predictions[i], probabilities[i] = self.entries[key]
+                self.hits += 1
+            elif key in missing:
+                missing[key].append(i)
+                self.hits += 1
+            else:
+                missing[key] = [i]
+                self.misses += 1
+        self.lookup_seconds += time.time() - start_time
+        return predictions, probabilities, missing
+
+    def store(self, missing, predictions, probabilities, new_predictions, new_probabilities, model_seconds):
+        """
+        Add the scores of the misses from lookup() to the cache and fill them into predictions and probabilities.
+
+        Args:
+        missing (dict): The misses returned by lookup()
+        predictions, probabilities: The arrays returned by lookup()
+        new_predictions, new_probabilities: Scores of the first row of every miss, in the order of missing
+        model_seconds (float): Time the model took to score them
+        """
+        self.model_seconds += model_seconds
+        self.model_articles += len(missing)
+        for (key, rows), prediction, probability in zip(missing.items(), new_predictions, new_probabilities):
+            predictions[rows] = prediction
+            probabilities[rows] = probability
+            self.entries[key] = (int(prediction), float(probability))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        """Copy of everything save() writes, which can be saved in another thread while the cache is still used."""
+        self.snapshots_taken += 1
+        return {'version': self.version, 'entries': OrderedDict(self.entries), 'model_seconds': self.model_seconds,
+                'model_articles': self.model_articles, 'snapshot': self.snapshots_taken}
+
+    def save(self, snapshot=None):
+        """
+        Args:
+        snapshot (dict): From snapshot(), the current cache if None
+        """
+        if self.path is None:
+            raise ValueError("The cache has no path to be saved to")
+        if snapshot is None:
+            snapshot = self.snapshot()
+        with self.save_lock:
+            if snapshot['snapshot'] < self.snapshot_saved:
+                return
+            # Written to a temporary file first, so a crash while saving does not leave a broken cache
+            temporary_path = self.path + '.tmp'
+            joblib.dump(snapshot, temporary_path)
+            os.replace(temporary_path, self.path)
+            self.snapshot_saved = snapshot['snapshot']
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        # Every hit saves the average time the model took per article, minus the time spent hashing
+        model_seconds_per_article = self.model_seconds / self.model_articles if self.model_articles else 0.0
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self.entries),
+            'seconds_saved': self.hits * model_seconds_per_article - self.lookup_seconds,
+        }
@@ -0,0 +1,212 @@
+import json
+import os
+import time
+import numpy as np
+import scipy.sparse as sp
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+from sklearn.preprocessing import normalize
+from utils.token_corpus import load_split, load_vocabulary, vectorize
+
+"""
+Approximate nearest neighbour index for finding the labelled articles most similar to a flagged one.
+
+Comparing a query with every article in the 50,000 dimensional TF-IDF matrix is too slow, so the index is an IVF
+(inverted file) over the TF-IDF vectors reduced with TruncatedSVD:
+- the reduced vectors are clustered with k-means into n_lists lists
+- a query is only compared with the articles in the n_probe lists with the closest centroids
+- the best rerank candidates by reduced similarity are reranked by their exact TF-IDF cosine similarity
+"""
+
+# Rows used to fit the SVD and k-means, the rest is only transformed
+FIT_SAMPLE = 100_000
+# Rows transformed at a time when building
+BLOCK_ROWS = 50_000
+
+
+class SimilarityIndex:
+    def __init__(self, index_dir):
+        """Load a saved index. The big arrays are memory-mapped."""
+        with open(os.path.join(index_dir, 'config.json')) as file:
+            self.config = json.load(file)
+        self.features = self.config['features']
+        self.idf = np.load(os.path.join(index_dir, 'idf.npy'))
+        self.components = np.load(os.path.join(index_dir, 'components.npy'))
+        self.centroids = np.load(os.path.join(index_dir, 'centroids.npy'))
+        self.list_offsets = np.load(os.path.join(index_dir, 'list_offsets.npy'))
+        self.reduced = np.load(os.path.join(index_dir, 'reduced.npy'), mmap_mode='r')
+        self.row_ids = np.load(os.path.join(index_dir, 'row_ids.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(index_dir, 'labels.npy'), mmap_mode='r')
+        # The TF-IDF matrix is kept as its three CSR arrays so it can be memory-mapped too (load_npz reads it all)
+        self.matrix = sp.csr_matrix((np.load(os.path.join(index_dir, 'tfidf_data.npy'), mmap_mode='r'),
+                                     np.load(os.path.join(index_dir, 'tfidf_indices.npy'), mmap_mode='r'),
+                                     np.load(os.path.join(index_dir, 'tfidf_indptr.npy'), mmap_mode='r')),
+                                    shape=tuple(self.config['shape']), copy=False)
+        self.vectorizer = CountVectorizer(vocabulary=self.features, tokenizer=str.split,
+                                          token_pattern=None, lowercase=False)
+
+    def vectorize(self, texts):
+        """TF-IDF vectors for 'content-tokens_stemmed' texts, in the same space as the index."""
+        counts = self.vectorizer.transform(texts).astype(np.float64)
+        return normalize(counts.multiply(self.idf).tocsr())
+
+    def reduce(self, matrix):
+        return normalize(np.asarray(matrix @ self.components.T, dtype=np.float32))
+
+    def query(self, matrix, k=10, n_probe=8, rerank=200, batch_size=64):
+        """
+        Find the k most similar training articles for every row of the TF-IDF matrix.
+        Returns (row ids, cosine similarities, labels), all of shape (n_queries, k). Rows with fewer
+        than k candidates are padded with id -1, similarity 0 and label -1.
+
+        Queries are answered batch_size at a time: every list probed by the batch is scored against
+        all the queries that probe it with one matrix product, and the candidates of the whole batch
+        are reranked with one sparse product.
+        """
+        matrix = sp.csr_matrix(matrix)
+        ids = np.full((matrix.shape[0], k), -1, dtype=np.int64)
+        similarities = np.zeros((matrix.shape[0], k), dtype=np.float32)
+        labels = np.full((matrix.shape[0], k), -1, dtype=np.int8)
+        for start in range(0, matrix.shape[0], batch_size):
+            batch = matrix[start:start + batch_size]
+            rows, exact = self._query_batch(batch, n_probe, rerank)
+            best = np.argsort(-exact, axis=1)[:, :k]
+            rows = np.take_along_axis(rows, best, axis=1)
+            exact = np.take_along_axis(exact, best, axis=1)
+            found = rows >= 0
+            end = start + batch.shape[0]
+            ids[start:end, :rows.shape[1]] = np.where(found, rows, -1)
+            similarities[start:end, :rows.shape[1]] = np.where(found, exact, 0)
+            labels[start:end, :rows.shape[1]][found] = self.labels[rows[found]]
+        return ids, similarities, labels
+
+    def _query_batch(self, matrix, n_probe, rerank):
+        # Candidate rows (-1 for none) and their exact similarities (-inf for none), shape (n_queries, <= rerank)
+        reduced = self.reduce(matrix)
+        closest_lists = np.argsort(-(reduced @ self.centroids.T), axis=1)[:, :n_probe]
+
+        # The best rerank candidates of a query are among the best rerank of every list it probes,
+        # so every (query, probe) gets a slot of rerank candidates
+        positions = np.full((matrix.shape[0], closest_lists.shape[1] * rerank), -1, dtype=np.int64)
+        scores = np.full(positions.shape, -np.inf, dtype=np.float32)
+        for l in np.unique(closest_lists):
+            queries, probes = np.nonzero(closest_lists == l)
+            list_start, list_end = self.list_offsets[l], self.list_offsets[l + 1]
+            if list_end == list_start:
+                continue
+            list_scores = reduced[queries] @ np.asarray(self.reduced[list_start:list_end]).T
+            if list_scores.shape[1] > rerank:
+                top = np.argpartition(-list_scores, rerank - 1, axis=1)[:, :rerank]
+            else:
+                top = np.broadcast_to(np.arange(list_scores.shape[1]), list_scores.shape)
+            columns = probes[:, None] * rerank + np.arange(top.shape[1])
+            positions[queries[:, None], columns] = list_start + top
+            scores[queries[:, None], columns] = np.take_along_axis(list_scores, top, axis=1)
+
+        if positions.shape[1] > rerank:
+            top = np.argpartition(-scores, rerank - 1, axis=1)[:, :rerank]
+            positions = np.take_along_axis(positions, top, axis=1)
+
+        # Exact cosine similarity of every candidate with its query, as one sparse product for the batch
+        found = positions >= 0
+        rows = np.full(positions.shape, -1, dtype=np.int64)
+        rows[found] = self.row_ids[positions[found]]
+        exact = np.full(positions.shape, -np.inf, dtype=np.float64)
+        queries = np.nonzero(found)[0]
+        exact[found] = np.asarray(self.matrix[rows[found]].multiply(matrix[queries]).sum(axis=1)).ravel()
+        return rows, exact
+
+    def exact_query(self, matrix, k=10, batch_size=32):
+        """Brute force cosine search over the whole TF-IDF matrix, to compare the index with."""
+        matrix = sp.csr_matrix(matrix)
+        ids = np.empty((matrix.shape[0], k), dtype=np.int64)
+        similarities = np.empty((matrix.shape[0], k), dtype=np.float32)
+        for start in range(0, matrix.shape[0], batch_size):
+            scores = (matrix[start:start + batch_size] @ self.matrix.T).toarray()
+            best = np.argpartition(-scores, k, axis=1)[:, :k]
+            order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1)
+            ids[start:start + batch_size] = np.take_along_axis(best, order, axis=1)
+            similarities[start:start + batch_size] = np.take_along_axis(scores, ids[start:start + batch_size], axis=1)
+        return ids, similarities
+
+
+def build_index(corpus_dir, index_dir, max_features=50_000, n_components=128, n_lists=None):
+    """
+    Build the index from the training split of the encoded token corpus (see token_corpus.py).
+    Uses the same features as the TfidfVectorizer in advanced_model.py had by default (50,000 most frequent tokens).
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    print("[#] Building TF-IDF matrix...")
+    splits, features = vectorize(corpus_dir, ('train',), max_features=max_features, min_df=1, max_df=1.0)
+    counts, labels = splits['train']
+    transformer = TfidfTransformer().fit(counts)
+    matrix = transformer.transform(counts).astype(np.float32).tocsr()
+    n_rows = matrix.shape[0]
+    n_lists = n_lists or max(1, int(np.sqrt(n_rows)))
+
+    rng = np.random.default_rng(42)
+    sample = np.sort(rng.choice(n_rows, size=min(FIT_SAMPLE, n_rows), replace=False))
+
+    print(f"[#] Fitting SVD with {n_components} components...")
+    svd = TruncatedSVD(n_components=n_components, random_state=42).fit(matrix[sample])
+    components = svd.components_.astype(np.float32)
+    reduced = np.empty((n_rows, n_components), dtype=np.float32)
+    for start in range(0, n_rows, BLOCK_ROWS):
+        reduced[start:start + BLOCK_ROWS] = normalize(matrix[start:start + BLOCK_ROWS] @ components.T)
+
+    print(f"[#] Clustering into {n_lists} lists...")
+    kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=42, n_init=3, batch_size=4096).fit(reduced[sample])
+    assignments = np.concatenate([kmeans.predict(reduced[start:start + BLOCK_ROWS])
+                                  for start in range(0, n_rows, BLOCK_ROWS)])
+
+    # Rows are stored list after list, so a list is a contiguous slice of the reduced vectors
+    row_ids = np.argsort(assignments, kind='stable')
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+
+    np.save(os.path.join(index_dir, 'idf.npy'), transformer.idf_)
+    np.save(os.path.join(index_dir, 'components.npy'), components)
+    np.save(os.path.join(index_dir, 'centroids.npy'), normalize(kmeans.cluster_centers_).astype(np.float32))
+    np.save(os.path.join(index_dir, 'list_offsets.npy'), list_offsets)
+    np.save(os.path.join(index_dir, 'reduced.npy'), reduced[row_ids])
+    np.save(os.path.join(index_dir, 'row_ids.npy'), row_ids)
+    np.save(os.path.join(index_dir, 'labels.npy'), np.asarray(labels))
+    np.save(os.path.join(index_dir, 'tfidf_data.npy'), matrix.data)
+    np.save(os.path.join(index_dir, 'tfidf_indices.npy'), matrix.indices)
+    np.save(os.path.join(index_dir, 'tfidf_indptr.npy'), matrix.indptr)
+    with open(os.path.join(index_dir, 'config.json'), 'w') as file:
+        json.dump({'features': features, 'n_components': n_components, 'n_lists': n_lists,
+                   'shape': list(matrix.shape)}, file)
+    print(f"[#] Index with {n_rows} articles saved to {index_dir}")
+
+
+def benchmark(index, queries, k=10, n_probe=8, rerank=200):
+    """Recall@k of the index against exact search, and queries per second of both."""
+    start_time = time.time()
+    exact_ids, _ = index.exact_query(queries, k)
+    exact_time = time.time() - start_time
+
+    start_time = time.time()
+    ids, _, _ = index.query(queries, k, n_probe, rerank)
+    index_time = time.time() - start_time
+
+    recall = np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(ids, exact_ids)])
+    n_queries = queries.shape[0]
+    print(f"[#] recall@{k}: {recall:.4f} (n_probe={n_probe}, rerank={rerank})")
+    print(f"[#] index: {n_queries / index_time:.1f} queries/sec, exact: {n_queries / exact_time:.1f} queries/sec")
+    return {'recall': recall, 'index_qps': n_queries / index_time, 'exact_qps': n_queries / exact_time}
+
+
+if __name__ == "__main__":
+    corpus_dir = './output/995,000_rows_encoded'
+    index_dir = './output/similarity_index'
+    build_index(corpus_dir, index_dir)
+
+    index = SimilarityIndex(index_dir)
+    # The first validation articles as queries, vectorized with the features and idf of the index
+    vocabulary = load_vocabulary(corpus_dir)
+    val = load_split(corpus_dir, 'val')
+    texts = [" ".join(vocabulary[token] for token in val.document(i)) for i in range(min(1000, len(val)))]
+    queries = index.vectorize(texts)
+    for n_probe in (4, 8, 16):
+        benchmark(index, queries, k=10, n_probe=n_probe)
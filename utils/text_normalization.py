@@ -0,0 +1,74 @@
+import os
+import re
+from nltk.stem.snowball import SnowballStemmer
+
+"""
+Python version of the cleaning steps in rust-preprocess/src/main.rs, for normalizing a few
+articles at a time (e.g. new articles at scoring time) without running the rust preprocessor.
+It gives the same 'content-tokens_stemmed' text as the preprocessor. Keep the two in sync.
+"""
+
+# Same patterns as RE_COMBINED in the rust preprocessor: dates, emails, urls and numbers
+RE_COMBINED = re.compile(r'''
+    (\b\d{4}-\d{2}-\d{2}\b|
+    \b\d{2}/\d{2}/\d{4}\b|
+    \b\d{2}\.\d{2}\.\d{4}\b|
+    \b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\s\d{1,2},?\s\d{4}\b|
+    \b\d{1,2}\s(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\b|
+    \b\d{1,2}(?:st|nd|rd|th)?\s(?:of\s)?(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\b)|
+    (\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b)|
+    (
+        https?://[^\s)\]}'<>"]+|
+        www\.[^\s)\]}'<>"]+|
+        \b[a-z0-9-]+\.[a-z]{2,}(?:/[^\s)\]}'<>"]*)*
+    )|
+    (\b\d+\b)
+''', re.VERBOSE | re.IGNORECASE)
+
+RE_UNUSED = re.compile(r"[^a-zA-Z <>]")
+RE_WHITESPACE = re.compile(r"\s+")
+
+PLACEHOLDERS = (" <DATE> ", " <EMAIL> ", " <URL> ", " <NUMBER> ")
+
+STOPWORDS_FILE = os.path.join(os.path.dirname(__file__), "..", "rust-preprocess", "stopwords.txt")
+
+with open(STOPWORDS_FILE) as file:
+    STOPWORDS = {line.strip().lower() for line in file}
+
+stemmer = SnowballStemmer("english")
+
+
+def _replace_entity(match):
+    # The groups are in the same order as PLACEHOLDERS
+    return PLACEHOLDERS[match.lastindex - 1]
+
+
+def clean_text(text: str) -> str:
+    """Lowercase, replace dates/emails/urls/numbers with placeholders and remove punctuation."""
+    text = RE_COMBINED.sub(_replace_entity, text.lower())
+    return RE_WHITESPACE.sub(" ", RE_UNUSED.sub(" ", text)).strip()
+
+
+def is_placeholder(token: str) -> bool:
+    return token.startswith("<") and token.endswith(">")
+
+
+def stem_tokens(text) -> list:
+    """Clean, tokenize, remove stopwords and stem an article, like the rust preprocessor."""
+    if not isinstance(text, str):
+        return []
+    tokens = clean_text(text).split()
+    filtered = [token for token in tokens if is_placeholder(token) or token not in STOPWORDS]
+    # The rust stemmer leaves the uppercase placeholders alone, nltk would lowercase them
+    return [token if is_placeholder(token) else stemmer.stem(token) for token in filtered]
+
+
+def normalize_content(text) -> str:
+    """Same text as the 'content-tokens_stemmed' column made by the rust preprocessor."""
+    return " ".join(stem_tokens(text))
+
+
+def identity_tokenizer(tokens):
+    """Tokenizer for CountVectorizer when the input is already split into tokens.
+    A module level function (unlike a lambda) can be pickled with the fitted vectorizer."""
+    return tokens
@@ -0,0 +1,199 @@
+import json
+import os
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfTransformer
+from utils.pandas_csv_reader import iter_csv_chunks
+
+"""
+Integer encoded token corpus.
+
+encode_splits() turns the processed splits into one global token dictionary and, for every split,
+a ragged array of uint32 token ids on disk: '<split>.data' holds the ids of all documents after
+each other and '<split>.offsets' where every document starts (document i is data[offsets[i]:offsets[i+1]]).
+This only has to be done once. load_split() memory-maps the arrays, so count/binary/TF-IDF matrices
+for any max_features/min_df/max_df can be built with NumPy instead of splitting and hashing strings.
+"""
+
+# Documents handled at a time when building matrices from the memory-mapped arrays
+BLOCK_DOCS = 50_000
+
+
+class TokenSplit:
+    """A memory-mapped split: offsets (int64, n_docs + 1), data (uint32 token ids) and labels (int8)."""
+
+    def __init__(self, offsets, data, labels):
+        self.offsets = offsets
+        self.data = data
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def document(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+    def blocks(self, block_docs=BLOCK_DOCS):
+        """Yield (offsets, data) for consecutive blocks of documents, with offsets starting at 0."""
+        for start in range(0, len(self), block_docs):
+            end = min(start + block_docs, len(self))
+            offsets = np.asarray(self.offsets[start:end + 1])
+            yield offsets - offsets[0], np.asarray(self.data[offsets[0]:offsets[-1]])
+
+
+def encode_splits(splits, output_dir, column='content-tokens_stemmed', label_column='label', positive_labels=('reliable', 'true'),
+                  memory_budget=500_000_000):
+    """
+    Encode processed csv splits with one shared token dictionary.
+
+    Args:
+    splits (dict): Split name -> path of the processed csv file, e.g. {'train': ..., 'val': ..., 'test': ...}
+    output_dir (str): Directory the encoded corpus is written to
+    column (str): Column with space separated tokens
+    label_column (str): Column with the labels, stored as 1 for positive_labels and 0 otherwise.
+        Both 'reliable' and 'true' by default, since the rust preprocessor writes reliable rows of
+        the validation split as 'true'
+    memory_budget (int): Bytes of csv data read at a time
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    vocabulary = {}
+    meta = {'column': column, 'positive_labels': list(positive_labels), 'splits': {}}
+
+    for split, csv_path in splits.items():
+        print(f"[#] Encoding {split} ({csv_path})...")
+        n_docs = 0
+        n_tokens = 0
+        with open(os.path.join(output_dir, f"{split}.data"), 'wb') as data_file, \
+             open(os.path.join(output_dir, f"{split}.offsets"), 'wb') as offsets_file, \
+             open(os.path.join(output_dir, f"{split}.labels"), 'wb') as labels_file:
+            np.zeros(1, dtype=np.int64).tofile(offsets_file)
+            for chunk in iter_csv_chunks(csv_path, columns=[column, label_column], dtypes={column: str},
+                                         memory_budget=memory_budget):
+                lengths = np.empty(len(chunk), dtype=np.int64)
+                ids = []
+                for i, text in enumerate(chunk[column].fillna('')):
+                    tokens = text.split()
+                    lengths[i] = len(tokens)
+                    # setdefault gives new tokens the next free id
+                    ids.extend(vocabulary.setdefault(token, len(vocabulary)) for token in tokens)
+                np.asarray(ids, dtype=np.uint32).tofile(data_file)
+                (n_tokens + np.cumsum(lengths)).tofile(offsets_file)
+                chunk[label_column].astype(str).str.lower().isin(positive_labels).to_numpy(dtype=np.int8).tofile(labels_file)
+                n_docs += len(chunk)
+                n_tokens += int(lengths.sum())
+        meta['splits'][split] = {'n_docs': n_docs, 'n_tokens': n_tokens}
+        print(f"[#] {split}: {n_docs} documents, {n_tokens} tokens, {len(vocabulary)} unique tokens so far")
+
+    meta['vocabulary_size'] = len(vocabulary)
+    with open(os.path.join(output_dir, 'vocabulary.json'), 'w') as file:
+        # Dicts keep insertion order, so the list index is the token id
+        json.dump(list(vocabulary), file)
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as file:
+        json.dump(meta, file, indent=2)
+
+
+def load_vocabulary(corpus_dir) -> list:
+    """Tokens by id."""
+    with open(os.path.join(corpus_dir, 'vocabulary.json')) as file:
+        return json.load(file)
+
+
+def load_split(corpus_dir, split) -> TokenSplit:
+    with open(os.path.join(corpus_dir, 'meta.json')) as file:
+        n_docs = json.load(file)['splits'][split]['n_docs']
+    path = os.path.join(corpus_dir, split)
+    # np.memmap can not map an empty file
+    if os.path.getsize(path + '.data') == 0:
+        data = np.zeros(0, dtype=np.uint32)
+    else:
+        data = np.memmap(path + '.data', dtype=np.uint32, mode='r')
+    return TokenSplit(
+        np.memmap(path + '.offsets', dtype=np.int64, mode='r', shape=(n_docs + 1,)),
+        data,
+        np.fromfile(path + '.labels', dtype=np.int8),
+    )
+
+
+def token_statistics(split: TokenSplit, vocabulary_size):
+    """Document frequency and total count of every token id in the split."""
+    document_frequency = np.zeros(vocabulary_size, dtype=np.int64)
+    term_frequency = np.zeros(vocabulary_size, dtype=np.int64)
+    for offsets, data in split.blocks():
+        term_frequency += np.bincount(data, minlength=vocabulary_size)
+        counts = _block_matrix(offsets, data, vocabulary_size)
+        document_frequency += np.bincount(counts.indices, minlength=vocabulary_size)
+    return document_frequency, term_frequency
+
+
+def select_features(split: TokenSplit, vocabulary_size, max_features=None, min_df=1, max_df=1.0):
+    """
+    Token ids to use as features, chosen like CountVectorizer does: tokens in fewer than min_df or more
+    than max_df documents (ints are counts, floats are proportions) are dropped, then the max_features
+    most frequent tokens are kept.
+    """
+    document_frequency, term_frequency = token_statistics(split, vocabulary_size)
+    n_docs = len(split)
+    min_count = min_df if isinstance(min_df, int) else min_df * n_docs
+    max_count = max_df if isinstance(max_df, int) else max_df * n_docs
+    keep = np.flatnonzero((document_frequency >= min_count) & (document_frequency <= max_count))
+    if max_features is not None and len(keep) > max_features:
+        # Stable sort so ties are broken the same way every time (CountVectorizer may pick a different token on ties)
+        keep = keep[np.argsort(-term_frequency[keep], kind='stable')[:max_features]]
+    return np.sort(keep)
+
+
+def _block_matrix(offsets, data, n_columns, dtype=np.int32):
+    # A csr matrix can be made directly from the ragged arrays, repeated tokens are then summed into counts
+    matrix = sp.csr_matrix((np.ones(len(data), dtype=dtype), data.astype(np.int32), offsets),
+                           shape=(len(offsets) - 1, n_columns))
+    matrix.sum_duplicates()
+    return matrix
+
+
+def count_matrix(split: TokenSplit, feature_ids, vocabulary_size, binary=False, dtype=np.int32):
+    """Document-term matrix over feature_ids (columns in the order of feature_ids)."""
+    column_of = np.full(vocabulary_size, -1, dtype=np.int64)
+    column_of[feature_ids] = np.arange(len(feature_ids))
+
+    blocks = []
+    for offsets, data in split.blocks():
+        columns = column_of[data]
+        kept = columns >= 0
+        # Offsets of the kept tokens: how many kept tokens come before each document start
+        kept_before = np.concatenate([[0], np.cumsum(kept)])
+        block = _block_matrix(kept_before[offsets], columns[kept], len(feature_ids), dtype)
+        if binary:
+            block.data[:] = 1
+        blocks.append(block)
+    if not blocks:
+        return sp.csr_matrix((0, len(feature_ids)), dtype=dtype)
+    return sp.vstack(blocks, format='csr')
+
+
+def vectorize(corpus_dir, splits=('train', 'val', 'test'), max_features=10_000, min_df=5, max_df=0.95,
+              binary=False, tfidf=False, dtype=np.int32):
+    """
+    Build matrices for the splits, with the features chosen on the first split (the training data).
+    Returns a dict of split -> (X, y) and the feature tokens.
+    With tfidf=True the counts are TF-IDF weighted like TfidfVectorizer (idf fitted on the first split).
+    """
+    vocabulary = load_vocabulary(corpus_dir)
+    loaded = {split: load_split(corpus_dir, split) for split in splits}
+    feature_ids = select_features(loaded[splits[0]], len(vocabulary), max_features, min_df, max_df)
+
+    matrices = {split: count_matrix(data, feature_ids, len(vocabulary), binary, dtype)
+                for split, data in loaded.items()}
+    if tfidf:
+        transformer = TfidfTransformer().fit(matrices[splits[0]])
+        matrices = {split: transformer.transform(matrix) for split, matrix in matrices.items()}
+
+    features = [vocabulary[i] for i in feature_ids]
+    return {split: (matrices[split], loaded[split].labels) for split in splits}, features
+
+
+if __name__ == "__main__":
+    encode_splits({
+        'train': './output/995,000_rows_processed_train.csv',
+        'val': './output/995,000_rows_processed_val.csv',
+        'test': './output/995,000_rows_processed_test.csv',
+    }, './output/995,000_rows_encoded')